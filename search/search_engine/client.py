@@ -132,12 +132,32 @@ class SearchClient:
                               body=esQuery)
         return hits
 
+    def get_words_by_ids(self, wordIds):
+        """
+        Retrieve several words or lemmata with one query.
+        """
+        wordIds = [str(wordId) for wordId in wordIds]
+        esQuery = {'query': {'ids': {'values': wordIds}}, 'size': len(wordIds)}
+        hits = self.es.search(index=self.name + '.words',
+                              body=esQuery)
+        return hits
+
     def get_doc_by_id(self, docId):
         esQuery = {'query': {'term': {'_id': docId}}}
         hits = self.es.search(index=self.name + '.docs',
                               body=esQuery)
         return hits
 
+    def get_docs_by_ids(self, docIds):
+        """
+        Retrieve several documents with one query.
+        """
+        docIds = [str(docId) for docId in docIds]
+        esQuery = {'query': {'ids': {'values': docIds}}, 'size': len(docIds)}
+        hits = self.es.search(index=self.name + '.docs',
+                              body=esQuery)
+        return hits
+
     def get_n_words(self):
         """
         Return total number of words in the primary language in the corpus.
@@ -1,5 +1,4 @@
 import re
-import os
 import json
 import random
 from .word_relations import WordRelations
@@ -19,17 +18,15 @@ class InterfaceQueryParser:
                      '|': 'should'}
 
     def __init__(self, settings_dir, settings, rp=None):
-        with open(os.path.join(settings_dir, 'categories.json'),
-                  'r', encoding='utf-8-sig') as fIn:
-            self.gramDict = json.loads(fIn.read())
         self.settings = settings
+        self.gramDict = self.settings.categories
 
         self.rxSimpleText = re.compile('^[^\\[\\]()*\\\\{}^$.?+~|,&]*$')
         self.rxBooleanText = re.compile('^[^\\[\\]()\\\\{}^$.+|]*$')
         if self.settings.regex_simple_search is not None and len(self.settings.regex_simple_search) > 0:
             self.rxSimpleText = re.compile(self.settings.regex_simple_search)
         self.wordFields = self.settings.word_fields
-        self.wr = WordRelations(settings_dir, rp=rp)
+        self.wr = WordRelations(self.settings, rp=rp)
         self.docMetaFields = ['author', 'title', 'genre']
         self.docMetaFields += [f for f in self.settings.viewable_meta
                                if f not in self.docMetaFields and f != 'filename'
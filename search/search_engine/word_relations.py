@@ -1,6 +1,4 @@
-import os
 import re
-import json
 
 
 class WordRelations:
@@ -12,13 +10,9 @@ class WordRelations:
 
     rxWordRelFields = re.compile('^word_(?:dist_)?(rel|from|to)_([0-9]+)_([0-9]+)')
 
-    def __init__(self, settings_dir, rp=None):
-        self.settings_dir = settings_dir
-        f = open(os.path.join(self.settings_dir, 'corpus.json'),
-                 'r', encoding='utf-8')
-        self.settings = json.loads(f.read())
-        f.close()
-        self.name = self.settings['corpus_name']
+    def __init__(self, settings, rp=None):
+        self.settings = settings    # CorpusSettings instance
+        self.name = self.settings.corpus_name
         self.rp = rp    # ResponseProcessor instance
         # self.sentView = sentence_viewer
 
@@ -197,7 +191,7 @@ class WordRelations:
         for c in constraints:
             relevantHighlights.add('w' + str(c[0]))
             relevantHighlights.add('w' + str(c[1]))
-            for pivotalTermPosition in range(self.settings['max_words_in_sentence']):
+            for pivotalTermPosition in range(self.settings.max_words_in_sentence):
                 relevantHighlights.add('w' + str(c[0]) + '_' + str(pivotalTermPosition))
                 relevantHighlights.add('w' + str(c[1]) + '_' + str(pivotalTermPosition))
         if len(relevantHighlights) <= 0:
@@ -5,7 +5,8 @@ import copy
 import math
 import re
 import jinja2
-from flask import render_template
+import markupsafe
+from flask import render_template, has_app_context
 try:
     from .transliteration import *
 except ImportError:
@@ -21,12 +22,16 @@ class SentenceViewer:
     viewable html.
     """
 
-    rxWordNo = re.compile('^w[0-9]+_([0-9]+)$')
     rxHitWordNo = re.compile('(?<=^w)[0-9]+')
-    rxTextSpans = re.compile('</?span.*?>|[^<>]+', flags=re.DOTALL)
+    rxWordKey = re.compile('^(w[0-9]+)(_[0-9]+)?$')
+    rxTextSpans = re.compile('</?span.*?>|&(?:amp|lt|gt);|[^<>&]+|&', flags=re.DOTALL)
     rxTabs = re.compile('^\t*$')
     rxKW = re.compile('_kw$')
+    rxEm = re.compile('</?em>')
     invisibleAnaFields = {'gloss_index'}
+    searchResultsTemplateDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            'templates', 'search_results')
+    maxPopupCacheSize = 4096
 
     def __init__(self, settings, search_client, fullText=False):
         """
@@ -46,23 +51,39 @@ class SentenceViewer:
             self.authorMeta = self.settings.author_metafield
         self.sc = search_client
         self.w1_labels = set(['w1'] + ['w1_' + str(i) for i in range(self.settings.max_words_in_sentence)])
+        self.jinjaEnvs = {}     # template directory -> Jinja2 environment for standalone use
         self.templates = {}     # Jinja2 template cache for standalone use
+        self.popupCache = {}    # word analyses -> (popup HTML, escaped popup HTML), see build_ana_popup
         self.fullText = fullText
 
     def render_jinja_html(self, templateDir, templateFilename, **context):
         """
         Render a flask template without flask context (needed if
         this file is imported from outside the package).
+        Templates are escaped the same way flask does it.
         """
         try:
             template = self.templates[(templateDir, templateFilename)]
         except KeyError:
-            template = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(templateDir + '/')
-            ).get_template(templateFilename)
+            if templateDir not in self.jinjaEnvs:
+                self.jinjaEnvs[templateDir] = jinja2.Environment(
+                    loader=jinja2.FileSystemLoader(templateDir + '/'),
+                    autoescape=jinja2.select_autoescape(['html', 'htm', 'xml', 'xhtml'])
+                )
+            template = self.jinjaEnvs[templateDir].get_template(templateFilename)
             self.templates[(templateDir, templateFilename)] = template
         return template.render(context)
 
+    def render_search_results_template(self, templateFilename, **context):
+        """
+        Render one of the templates in templates/search_results
+        with flask or, if there is no flask application context
+        (e.g. when generating full-text HTML files), without it.
+        """
+        if has_app_context():
+            return render_template('search_results/' + templateFilename, **context)
+        return self.render_jinja_html(self.searchResultsTemplateDir, templateFilename, **context)
+
     def differing_ana_field(self, ana1, ana2):
         """
         Determine if two analyses with equal number of fields only differ
@@ -99,20 +120,18 @@ class SentenceViewer:
         if len(glossParts1) != len(glossParts2):
             return None
         nDifferences = 0
-        joinedGloss = ''
+        joinedGlossParts = []
         for iGloss in range(len(glossParts1)):
-            if iGloss != 0:
-                joinedGloss += '-'
             if glossParts1[iGloss] == glossParts2[iGloss]:
-                joinedGloss += glossParts1[iGloss]
+                joinedGlossParts.append(glossParts1[iGloss])
             else:
                 if nDifferences >= 1:
                     return None
                 nDifferences += 1
                 newGlossPart = list(set(glossParts1[iGloss].split('/') + glossParts2[iGloss].split('/')))
                 newGlossPart.sort()
-                joinedGloss += '/'.join(newGlossPart)
-        return joinedGloss
+                joinedGlossParts.append('/'.join(newGlossPart))
+        return '-'.join(joinedGlossParts)
 
     def simplify_ana(self, analyses, matchingAnalyses):
         """
@@ -171,19 +190,19 @@ class SentenceViewer:
         Build a string with gramtags ordered according to the settings
         for the language specified by lang.
         """
+        grFieldsOrder = None
+        if lang in self.settings.lang_props and 'gr_fields_order' in self.settings.lang_props[lang]:
+            grFieldsOrder = self.settings.lang_props[lang]['gr_fields_order']
+
         def key_comp(p):
-            if 'gr_fields_order' not in self.settings.lang_props[lang]:
+            if grFieldsOrder is None:
                 return -1
-            if p[0] not in self.settings.lang_props[lang]['gr_fields_order']:
-                return len(self.settings.lang_props[lang]['gr_fields_order'])
-            return self.settings.lang_props[lang]['gr_fields_order'].index(p[0])
+            if p[0] not in grFieldsOrder:
+                return len(grFieldsOrder)
+            return grFieldsOrder.index(p[0])
 
-        grAnaPart = ''
-        for fv in sorted(grValues, key=key_comp):
-            if len(grAnaPart) > 0:
-                grAnaPart += ', '
-            grAnaPart += fv[1]
-        return grAnaPart
+        return ', '.join(fv[1] for fv in sorted(grValues, key=key_comp)
+                         if len(fv[1]) > 0)
 
     def build_gr_ana_part(self, grValues, lang, gramdic=False):
         """
@@ -193,26 +212,23 @@ class SentenceViewer:
         """
         grAnaPart = self.build_gr_ana_part_text(grValues, lang)
         if not gramdic:
-            try:
-                return render_template('search_results/grammar_popup.html', grAnaPart=grAnaPart).strip()
-            except AttributeError:
-                return self.render_jinja_html('../search/web_app/templates/search_results',
-                                              'grammar_popup.html', grAnaPart=grAnaPart).strip()
-        try:
-            return render_template('search_results/gramdic_popup.html', grAnaPart=grAnaPart).strip()
-        except AttributeError:
-            return self.render_jinja_html('../search/web_app/templates/search_results',
-                                          'gramdic_popup.html', grAnaPart=grAnaPart).strip()
+            return self.render_search_results_template('grammar_popup.html', grAnaPart=grAnaPart).strip()
+        return self.render_search_results_template('gramdic_popup.html', grAnaPart=grAnaPart).strip()
 
     def build_ana_div(self, ana, lang, translit=None):
         """
         Build the contents of a div with one particular analysis.
         """
+        langProps = self.settings.lang_props[lang]
+        dictionaryCategories = set()
+        if lang in self.dictionary_categories:
+            dictionaryCategories = self.dictionary_categories[lang]
+
         def field_sorting_key(x):
-            if x['key'] in self.settings.lang_props[lang]['other_fields_order']:
-                return (self.settings.lang_props[lang]['other_fields_order'].index(x['key']),
+            if x['key'] in langProps['other_fields_order']:
+                return (langProps['other_fields_order'].index(x['key']),
                         x['key'])
-            return (len(self.settings.lang_props[lang]['other_fields_order']),
+            return (len(langProps['other_fields_order']),
                     x['key'])
 
         ana4template = {'lex': '', 'pos': '', 'grdic': '', 'lex_fields': [], 'gr': '', 'other_fields': []}
@@ -228,15 +244,15 @@ class SentenceViewer:
                 if type(value) == list:
                     value = ', '.join(value)
                 if field.startswith('gr.'):
-                    if lang in self.dictionary_categories and field[3:] in self.dictionary_categories[lang]:
+                    if field[3:] in dictionaryCategories:
                         grdicValues.append((field[3:], value))
                     else:
                         grValues.append((field[3:], value))
-                elif ('exclude_fields' in self.settings.lang_props[lang]
-                      and field in self.settings.lang_props[lang]['exclude_fields']):
+                elif ('exclude_fields' in langProps
+                      and field in langProps['exclude_fields']):
                     continue
-                elif ('lexical_fields' in self.settings.lang_props[lang]
-                      and field in self.settings.lang_props[lang]['lexical_fields']):
+                elif ('lexical_fields' in langProps
+                      and field in langProps['lexical_fields']):
                     # Lexical fields are displayed between the lemma+pos and the gr lines
                     ana4template['lex_fields'].append({'key': field, 'value': value})
                 else:
@@ -244,52 +260,77 @@ class SentenceViewer:
                     ana4template['other_fields'].append({'key': field, 'value': value})
         ana4template['grdic'] = self.build_gr_ana_part(grdicValues, lang, gramdic=True)
         ana4template['gr'] = self.build_gr_ana_part(grValues, lang, gramdic=False)
-        if 'other_fields_order' in self.settings.lang_props[lang]:
+        if 'other_fields_order' in langProps:
             ana4template['lex_fields'].sort(key=field_sorting_key)
             ana4template['other_fields'].sort(key=field_sorting_key)
         else:
             # Order analysis fields alphabetically
             ana4template['lex_fields'].sort(key=lambda x: x['key'])
             ana4template['other_fields'].sort(key=lambda x: x['key'])
-        try:
-            return render_template('search_results/analysis_div.html', ana=ana4template).strip()
-        except AttributeError:
-            return self.render_jinja_html('../search/web_app/templates/search_results',
-                                          'analysis_div.html', ana=ana4template).strip()
+        return self.render_search_results_template('analysis_div.html', ana=ana4template).strip()
+
+    def ana_popup_key(self, word, lang, matchingAnalyses, translit):
+        """
+        Return a hashable representation of everything the popup
+        for the word depends on.
+        """
+        analyses = ()
+        if 'ana' in word:
+            analyses = tuple(tuple(sorted((k, tuple(v) if type(v) == list else v)
+                                          for k, v in ana.items()))
+                             for ana in word['ana'])
+        return (word.get('wf'), word.get('wf_display'), analyses,
+                lang, translit, frozenset(matchingAnalyses))
 
-    def build_ana_popup(self, word, lang, matchingAnalyses=None, translit=None):
+    def build_ana_popup(self, word, lang, matchingAnalyses=None, translit=None, escape=False):
         """
-        Build a string for a popup with the word and its analyses. 
+        Build a string for a popup with the word and its analyses.
+        If escape is True, return it HTML-escaped, ready to be put
+        in a data-ana attribute.
+        The same words tend to occur many times, so the popups
+        are cached together with their escaped versions.
         """
         if matchingAnalyses is None:
             matchingAnalyses = []
+        popupKey = self.ana_popup_key(word, lang, matchingAnalyses, translit)
+        popups = self.popupCache.get(popupKey)    # the cache may be cleared by another thread
+        if popups is not None:
+            return popups[1] if escape else popups[0]
         data4template = {'wf': '', 'analyses': []}
         if 'wf_display' in word:
             data4template['wf_display'] = self.transliterate_baseline(word['wf_display'], lang=lang, translit=translit)
         elif 'wf' in word:
             data4template['wf'] = html.escape(self.transliterate_baseline(word['wf'], lang=lang, translit=translit))
         if 'ana' in word:
-            simplifiedAnas, simpleMatchingAnalyses = self.simplify_ana(word['ana'], matchingAnalyses)
+            # simplify_ana changes the analyses, so it gets copies
+            simplifiedAnas, simpleMatchingAnalyses = self.simplify_ana([dict(ana) for ana in word['ana']],
+                                                                       matchingAnalyses)
             for iAna in range(len(simplifiedAnas)):
                 ana4template = {'match': iAna in simpleMatchingAnalyses,
                                 'ana_div': self.build_ana_div(simplifiedAnas[iAna], lang, translit=translit)}
                 data4template['analyses'].append(ana4template)
-        try:
-            return render_template('search_results/analyses_popup.html', data=data4template)
-        except AttributeError:
-            return self.render_jinja_html('../search/web_app/templates/search_results',
-                                          'analyses_popup.html', data=data4template)
+        popup = self.render_search_results_template('analyses_popup.html', data=data4template)
+        popups = (popup, str(markupsafe.escape(popup)))
+        if len(self.popupCache) >= self.maxPopupCacheSize:
+            self.popupCache.clear()
+        self.popupCache[popupKey] = popups
+        return popups[1] if escape else popups[0]
 
     def prepare_analyses(self, words, indexes, lang, matchWordOffsets=None, translit=None):
         """
         Generate viewable analyses for the words with given indexes.
+        Return them HTML-escaped, as they go to the data-ana attribute.
         """
-        result = ''
+        result = []
         for iStr in indexes:
-            mWordNo = self.rxWordNo.search(iStr)
-            if mWordNo is None:
+            # Word IDs look like w<sentence number>_<word number>, other
+            # IDs (paragraphs, media alignment) do not start with w
+            if not iStr.startswith('w'):
+                continue
+            try:
+                i = int(iStr[iStr.rindex('_') + 1:])
+            except ValueError:
                 continue
-            i = int(mWordNo.group(1))
             if i < 0 or i >= len(words):
                 continue
             word = words[i]
@@ -298,30 +339,37 @@ class SentenceViewer:
             matchingAnalyses = []
             if matchWordOffsets is not None and iStr in matchWordOffsets:
                 matchingAnalyses = [offAna[1] for offAna in matchWordOffsets[iStr]]
-            result += self.build_ana_popup(word, lang, matchingAnalyses=matchingAnalyses, translit=translit)
-        # result = result.replace('"', "&quot;").replace('<', '&lt;').replace('>', '&gt;')
-        return result
+            result.append(self.build_ana_popup(word, lang, matchingAnalyses=matchingAnalyses,
+                                               translit=translit, escape=True))
+        return ''.join(result)
 
     def build_span(self, sentSrc, curWords, curStyles, lang, matchWordOffsets, translit=None):
         """
         Build a string with a starting span for a word in the baseline.
         """
+        hasWords = hasParas = hasSrc = False
+        for wn in curWords:
+            if wn.startswith('w'):
+                hasWords = True
+            elif wn.startswith('p'):
+                hasParas = True
+            elif wn.startswith('src'):
+                hasSrc = True
         curClass = ''
-        if any(wn.startswith('w') for wn in curWords):
+        if hasWords:
             curClass += ' word '
-        if any(wn.startswith('p') for wn in curWords):
+        if hasParas:
             curClass += ' para '
-        if not self.fullText and any(wn.startswith('src') for wn in curWords):
+        if not self.fullText and hasSrc:
             curClass += ' src '
         curClass = curClass.lstrip()
 
-        if 'word' in curClass:
+        if hasWords:
             dataAna = self.prepare_analyses(sentSrc['words'], curWords,
                                             lang, matchWordOffsets,
                                             translit=translit)
         else:
             dataAna = ''
-        dataAna = html.escape(dataAna)
 
         def highlightClass(nWord):
             if nWord in matchWordOffsets:
@@ -330,12 +378,10 @@ class SentenceViewer:
                                                         for anaOff in matchWordOffsets[nWord]))
             return ''
 
-        spanStart = '<span class="' + curClass + \
-                    ' '.join(wn + highlightClass(wn)
-                             for wn in curWords) + '" data-ana="' + dataAna + '">'
-        for styleTag in curStyles:
-            spanStart += styleTag
-        return spanStart
+        return '<span class="' + curClass + \
+               ' '.join(wn + highlightClass(wn)
+                        for wn in curWords) + '" data-ana="' + dataAna + '">' + \
+               ''.join(curStyles)
 
     def add_highlighted_offsets(self, offStarts, offEnds, text):
         """
@@ -343,23 +389,32 @@ class SentenceViewer:
         and store their offsets in the respective lists.
         """
         indexSubtr = 0  # <em>s that appeared due to highlighting should be subtracted
-        for i in range(len(text) - 4):
-            if text[i] != '<':
-                continue
-            if text[i:i+4] == '<em>':
-                try:
-                    offStarts[i - indexSubtr].add('smatch')
-                except KeyError:
-                    offStarts[i - indexSubtr] = {'smatch'}
-                indexSubtr += 4
-            elif text[i:i+5] == '</em>':
-                try:
-                    offEnds[i - indexSubtr].add('smatch')
-                except KeyError:
-                    offEnds[i - indexSubtr] = {'smatch'}
-                indexSubtr += 5
+        for m in self.rxEm.finditer(text):
+            if m.group(0) == '<em>':
+                offStarts.setdefault(m.start() - indexSubtr, set()).add('smatch')
+            else:
+                offEnds.setdefault(m.start() - indexSubtr, set()).add('smatch')
+            indexSubtr += len(m.group(0))
+
+    def get_docs_meta(self, docIDs):
+        """
+        Retrieve the metadata of several documents at once.
+        Return a dictionary {document ID as string: document
+        metadata or None if the document was not found}. It can
+        be passed to process_sentence_header as docCache.
+        """
+        docCache = {str(docID): None for docID in docIDs}
+        if len(docCache) <= 0:
+            return docCache
+        response = self.sc.get_docs_by_ids(docCache.keys())
+        if 'hits' not in response or 'hits' not in response['hits']:
+            return docCache
+        for hit in response['hits']['hits']:
+            if '_source' in hit:
+                docCache[str(hit['_id'])] = hit['_source']
+        return docCache
 
-    def process_sentence_header(self, sentSource, format='html'):
+    def process_sentence_header(self, sentSource, format='html', docCache=None):
         """
         Retrieve the metadata of the document the sentence
         belongs to. Return a string with this data that can
@@ -369,20 +424,29 @@ class SentenceViewer:
         In the latter case, the first element should contain
         a short description string, including things such as
         authour or title.
+        If docCache (see get_docs_meta) contains the document,
+        the database is not queried.
         """
         docID = sentSource['doc_id']
-        meta = self.sc.get_doc_by_id(docID)
-        if (meta is None
-                or 'hits' not in meta
-                or 'hits' not in meta['hits']
-                or len(meta['hits']['hits']) <= 0
-                or '_source' not in meta['hits']['hits'][0]):
+        if docCache is not None and str(docID) in docCache:
+            meta = docCache[str(docID)]
+        else:
+            meta = self.sc.get_doc_by_id(docID)
+            if (meta is not None
+                    and 'hits' in meta
+                    and 'hits' in meta['hits']
+                    and len(meta['hits']['hits']) > 0
+                    and '_source' in meta['hits']['hits'][0]):
+                meta = meta['hits']['hits'][0]['_source']
+            else:
+                meta = None
+        if meta is None:
             if format == 'csv':
                 return ['']
             else:
                 return render_template('search_results/sentence_header.html',
                                        fulltext_view_enabled=False)
-        meta = meta['hits']['hits'][0]['_source']
+        meta = copy.copy(meta)  # it may be shared with other sentences
         for k in meta:
             if type(meta[k]) == list:
                 meta[k] = '; '.join(meta[k])
@@ -401,22 +465,25 @@ class SentenceViewer:
         metaHtml = html.escape(metaHtml)
 
         if format == 'csv':
-            result = ['']
+            description = []
             if 'title' in meta:
-                result[0] += '"' + meta['title'] + '" '
+                description.append('"' + meta['title'] + '" ')
             else:
-                result[0] += '"???" '
+                description.append('"???" ')
             if self.authorMeta in meta and len(meta[self.authorMeta]) > 0:
-                result[0] += '(' + meta[self.authorMeta] + ') '
+                description.append('(' + meta[self.authorMeta] + ') ')
             if 'issue' in meta and len(meta['issue']) > 0:
-                result[0] += meta['issue'] + ' '
+                description.append(meta['issue'] + ' ')
             if len(dateDisplay) > 0:
-                result[0] += '[' + dateDisplay + ']'
-            meta = {self.rxKW.sub('', k): v
-                    for k, v in meta.items()
-                    if self.rxKW.sub('', k) in self.settings.viewable_meta
-                    and k not in ['filename', 'filename_kw']}
-            for k, v in sorted(meta.items()):
+                description.append('[' + dateDisplay + ']')
+            result = [''.join(description)]
+            viewableMeta = self.settings.viewable_meta
+            metaViewable = {}
+            for k, v in meta.items():
+                fieldName = self.rxKW.sub('', k)
+                if fieldName in viewableMeta and k not in ['filename', 'filename_kw']:
+                    metaViewable[fieldName] = v
+            for k, v in sorted(metaViewable.items()):
                 newField = '[' + k + ': ' + v.replace('\t', ' ') + ']'
                 if newField not in result:
                     result.append(newField)
@@ -437,24 +504,19 @@ class SentenceViewer:
         The keys are offsets and the values are the string IDs of the words.
         """
         offStarts, offEnds = {}, {}
-        for iWord in range(len(sSource['words'])):
+        wnPrefix = 'w' + str(numSent) + '_'
+        for iWord, word in enumerate(sSource['words']):
             try:
-                if sSource['words'][iWord]['wtype'] != 'word':
+                if word['wtype'] != 'word':
                     continue
-                offStart, offEnd = sSource['words'][iWord]['off_start'], sSource['words'][iWord]['off_end']
+                offStart, offEnd = word['off_start'], word['off_end']
             except KeyError:
                 continue
-            wn = 'w' + str(numSent) + '_' + str(iWord)
+            wn = wnPrefix + str(iWord)
             if matchOffsets is not None and wn not in matchOffsets:
                 continue
-            try:
-                offStarts[offStart].add(wn)
-            except KeyError:
-                offStarts[offStart] = {wn}
-            try:
-                offEnds[offEnd].add(wn)
-            except KeyError:
-                offEnds[offEnd] = {wn}
+            offStarts.setdefault(offStart, set()).add(wn)
+            offEnds.setdefault(offEnd, set()).add(wn)
         return offStarts, offEnds
 
     def get_para_offsets(self, sSource):
@@ -467,21 +529,14 @@ class SentenceViewer:
         if 'para_alignment' not in sSource or 'doc_id' not in sSource:
             return offStarts, offEnds
         docID = sSource['doc_id']
-        for iPA in range(len(sSource['para_alignment'])):
-            pa = sSource['para_alignment'][iPA]
+        for pa in sSource['para_alignment']:
             try:
                 offStart, offEnd = pa['off_start'], pa['off_end']
             except KeyError:
                 continue
             pID = 'p' + str(pa['para_id']) + str(docID)
-            try:
-                offStarts[offStart].add(pID)
-            except KeyError:
-                offStarts[offStart] = {pID}
-            try:
-                offEnds[offEnd].add(pID)
-            except KeyError:
-                offEnds[offEnd] = {pID}
+            offStarts.setdefault(offStart, set()).add(pID)
+            offEnds.setdefault(offEnd, set()).add(pID)
         return offStarts, offEnds
 
     def get_src_offsets(self, sSource):
@@ -496,8 +551,7 @@ class SentenceViewer:
         if self.fullText or 'src_alignment' not in sSource or 'doc_id' not in sSource:
             return offStarts, offEnds, fragmentInfo
         docID = sSource['doc_id']
-        for iSA in range(len(sSource['src_alignment'])):
-            sa = sSource['src_alignment'][iSA]
+        for sa in sSource['src_alignment']:
             try:
                 offStart, offEnd = sa['off_start_sent'], sa['off_end_sent']
             except KeyError:
@@ -507,14 +561,8 @@ class SentenceViewer:
                                    'end': sa['off_end_src'],
                                    'src': sa['src'],
                                    'mtype': sa['mtype']}
-            try:
-                offStarts[offStart].add(srcID)
-            except KeyError:
-                offStarts[offStart] = {srcID}
-            try:
-                offEnds[offEnd].add(srcID)
-            except KeyError:
-                offEnds[offEnd] = {srcID}
+            offStarts.setdefault(offStart, set()).add(srcID)
+            offEnds.setdefault(offEnd, set()).add(srcID)
         return offStarts, offEnds, fragmentInfo
 
     def get_style_offsets(self, sSource):
@@ -528,25 +576,19 @@ class SentenceViewer:
         offStarts, offEnds = {}, {}
         if 'style_spans' not in sSource:
             return offStarts, offEnds
-        for iSpan in range(len(sSource['style_spans'])):
+        for span in sSource['style_spans']:
             try:
-                offStart, offEnd = sSource['style_spans'][iSpan]['off_start'], sSource['style_spans'][iSpan]['off_end']
+                offStart, offEnd = span['off_start'], span['off_end']
             except KeyError:
                 continue
-            styleClass = 'style_' + sSource['style_spans'][iSpan]['span_class']
+            styleClass = 'style_' + span['span_class']
             tooltipText = ''
-            if 'tooltip_text' in sSource['style_spans'][iSpan]:
-                tooltipText = sSource['style_spans'][iSpan]['tooltip_text']
+            if 'tooltip_text' in span:
+                tooltipText = span['tooltip_text']
             styleSpan = '<span class="style_span ' + styleClass \
                         + '" data-tooltip-text="' + tooltipText + '">'
-            try:
-                offStarts[offStart].add(styleSpan)
-            except KeyError:
-                offStarts[offStart] = {styleSpan}
-            try:
-                offEnds[offEnd].add(styleSpan)
-            except KeyError:
-                offEnds[offEnd] = {styleSpan}
+            offStarts.setdefault(offStart, set()).add(styleSpan)
+            offEnds.setdefault(offEnd, set()).add(styleSpan)
         return offStarts, offEnds
 
     def relativize_src_alignment(self, expandedContext, srcFiles):
@@ -602,13 +644,24 @@ class SentenceViewer:
         if translitFuncName not in localNames:
             return text
         translit_func = localNames[translitFuncName]
-        textTranslit = ''
-        for span in spans:
-            if span.startswith('<'):
-                textTranslit += span
-            else:
-                textTranslit += translit_func(span, lang)
-        return textTranslit
+        return ''.join(span if span.startswith(('<', '&')) else translit_func(span, lang)
+                       for span in spans)
+
+    def baseline_fragment(self, text, start, end, trailStart, format='html'):
+        """
+        Return the part of the sentence text between start and end offsets,
+        with newlines and HTML special characters replaced for the output format.
+        trailStart is the offset where the trailing newlines begin. The
+        fragment is expected not to cross offset 1 or trailStart.
+        """
+        fragment = text[start:end]
+        if format == 'csv':
+            return fragment.replace('\n', '\\n ')
+        fragment = html.escape(fragment, quote=False)
+        if start >= trailStart or start == 0:
+            # Leading and trailing newlines do not break the line
+            return fragment.replace('\n', '<span class="newline"></span>')
+        return fragment.replace('\n', '<br>')
 
     def view_sentence_meta(self, sSource, format):
         """
@@ -621,27 +674,20 @@ class SentenceViewer:
                      for k in sSource['meta'] if k not in ['sent_analyses', 'sent_analyses_kw']}
         if len(meta2show) <= 0:
             return ''
-        metaSpan = '<span class="sentence_meta">'
         if format == 'csv':
-            metaSpan = ''
-        for k, v in sorted(meta2show.items()):
-            if format == 'csv':
-                metaSpan += '[' + k + ': ' + str(v).replace('\t', ' ') + ']\t'
-            else:
-                metaSpan += html.escape(k + ': ' + str(v))
-                metaSpan += '<br>'
-        if format == 'csv':
-            metaSpan = metaSpan.strip(' ')
-        else:
-            if metaSpan.endswith('<br>'):
-                metaSpan = metaSpan[:-4]
-            metaSpan += '</span>'
-        return metaSpan
+            return ''.join('[' + k + ': ' + str(v).replace('\t', ' ') + ']\t'
+                           for k, v in sorted(meta2show.items())).strip(' ')
+        return '<span class="sentence_meta">' \
+               + '<br>'.join(html.escape(k + ': ' + str(v))
+                             for k, v in sorted(meta2show.items())) \
+               + '</span>'
 
-    def process_sentence(self, s, numSent=1, getHeader=False, lang='', langView='', translit=None, format='html'):
+    def process_sentence(self, s, numSent=1, getHeader=False, lang='', langView='', translit=None, format='html',
+                         docCache=None):
         """
         Process one sentence taken from response['hits']['hits'].
-        If getHeader is True, retrieve the metadata from the database.
+        If getHeader is True, retrieve the metadata from the database
+        (or from docCache, see process_sentence_header).
         Return dictionary {'header': document header HTML,
                            {'languages': {'<language_name>': {'text': sentence HTML[,
                                'img': related image name,
@@ -658,7 +704,7 @@ class SentenceViewer:
 
         header = {}
         if getHeader:
-            header = self.process_sentence_header(sSource, format)
+            header = self.process_sentence_header(sSource, format, docCache=docCache)
         if 'highlight' in s and 'text' in s['highlight']:
             highlightedText = s['highlight']['text']
             if type(highlightedText) == list:
@@ -671,7 +717,7 @@ class SentenceViewer:
         if 'words' not in sSource:
             return {'languages': {langView: {'text': highlightedText,
                                              'highlighted_text': highlightedText}}}
-        chars = list(sSource['text'])
+        text = sSource['text']
         if format == 'csv':
             offParaStarts, offParaEnds = {}, {}
             offSrcStarts, offSrcEnds, fragmentInfo = {}, {}, {}
@@ -685,22 +731,23 @@ class SentenceViewer:
             offStarts, offEnds = self.get_word_offsets(sSource, numSent)
             self.add_highlighted_offsets(offStarts, offEnds, highlightedText)
 
+        # Only the offsets where some span starts or ends need to be
+        # looked at; the text between them is copied slice by slice.
+        # Offsets 1 and trailStart are added so that no slice contains
+        # both newlines that become <br>s and those that become empty spans.
+        events = set(offStarts) | set(offEnds) | set(offParaStarts) | set(offParaEnds) \
+                 | set(offSrcStarts) | set(offSrcEnds) | set(offStyleStarts) | set(offStyleEnds)
+        trailStart = len(text.rstrip('\n'))
+        boundaries = sorted(i for i in events | {1, trailStart} if 0 <= i < len(text))
+        out = []
+        prev = 0
         curWords = set()
         curStyles = set()
-        for i in range(len(chars)):
-            if chars[i] == '\n':
-                if format == 'csv':
-                    chars[i] = '\\n '
-                elif (i == 0 or i == len(chars) - 1
-                        or all(chars[j] == '\n'
-                               for j in range(i+1, len(chars)))):
-                    chars[i] = '<span class="newline"></span>'
-                else:
-                    chars[i] = '<br>'
-            elif chars[i] == '<' and format != 'csv':
-                chars[i] = '&lt;'
-            elif chars[i] == '>' and format != 'csv':
-                chars[i] = '&gt;'
+        for i in boundaries:
+            out.append(self.baseline_fragment(text, prev, i, trailStart, format))
+            prev = i
+            if i not in events:
+                continue
 
             # Add style tags (italics, superscript, etc.)
             styleSpanEndAddition = ''
@@ -710,12 +757,13 @@ class SentenceViewer:
             if (i not in offStarts and i not in offEnds
                     and i not in offParaStarts and i not in offParaEnds
                     and i not in offSrcStarts and i not in offSrcEnds):
+                addition = ''
                 if i in offStyleStarts:
                     for styleSpan in offStyleStarts[i]:
                         if styleSpan not in curStyles:
                             curStyles.add(styleSpan)
-                            chars[i] = styleSpan + chars[i]
-                chars[i] = styleSpanEndAddition + chars[i]
+                            addition = styleSpan + addition
+                out.append(styleSpanEndAddition + addition)
                 continue
 
             # Add word and alignment tags
@@ -754,18 +802,19 @@ class SentenceViewer:
                     addition = '{{'
                 else:
                     addition += self.build_span(sSource, curWords, curStyles, lang, matchWordOffsets, translit=translit)
-            chars[i] = styleSpanEndAddition + addition + chars[i]
+            out.append(styleSpanEndAddition + addition)
+        out.append(self.baseline_fragment(text, prev, len(text), trailStart, format))
         if len(curWords) > 0:
             if format == 'csv':
-                chars[-1] += '}}'
+                out.append('}}')
             else:
-                chars[-1] += '</span>'
-        chars[-1] += '</span>' * len(curStyles)
+                out.append('</span>')
+        out.append('</span>' * len(curStyles))
         relationsSatisfied = True
         if 'toggled_on' in s and not s['toggled_on']:
             relationsSatisfied = False
         text = self.view_sentence_meta(sSource, format) +\
-               self.transliterate_baseline(''.join(chars), lang=lang, translit=translit)
+               self.transliterate_baseline(''.join(out), lang=lang, translit=translit)
         langViewContents = {'text': text, 'highlighted_text': highlightedText}
         if self.settings.images and 'img' in sSource['meta']:
             langViewContents['img'] = sSource['meta']['img']
@@ -783,24 +832,22 @@ class SentenceViewer:
         either as a simple text example or as a glossed example in a
         linguistic paper.
         """
+        grFieldsOrder = None
+        if lang in self.settings.lang_props and 'gr_fields_order' in self.settings.lang_props[lang]:
+            grFieldsOrder = self.settings.lang_props[lang]['gr_fields_order']
+
         def key_comp(p):
-            if 'gr_fields_order' not in self.settings.lang_props[lang]:
+            if grFieldsOrder is None:
                 return -1
-            if p[0] not in self.settings.lang_props[lang]['gr_fields_order']:
-                return len(self.settings.lang_props[lang]['gr_fields_order'])
-            return self.settings.lang_props[lang]['gr_fields_order'].index(p[0])
+            if p[0] not in grFieldsOrder:
+                return len(grFieldsOrder)
+            return grFieldsOrder.index(p[0])
 
         def get_ana_gramm(ana):
-            grAnaPart = ''
             grValues = [(k[3:], v) for k, v in ana.items() if k.startswith('gr.')]
-            for fv in sorted(grValues, key=key_comp):
-                if len(grAnaPart) > 0:
-                    grAnaPart += ', '
-                if type(fv[1]) == str:
-                    grAnaPart += fv[1]
-                else:
-                    grAnaPart += ', '.join(grTag for grTag in sorted(fv[1]))
-            return grAnaPart
+            grTags = (fv[1] if type(fv[1]) == str else ', '.join(grTag for grTag in sorted(fv[1]))
+                      for fv in sorted(grValues, key=key_comp))
+            return ', '.join(grTag for grTag in grTags if len(grTag) > 0)
 
         if 'text' not in s or len(s['text']) <= 0:
             return {''}
@@ -923,7 +970,7 @@ class SentenceViewer:
             wID = w['_id']  # word or lemma found in the words index
         if searchType == 'word':
             return render_template('search_results/word_table_row.html',
-                                   ana_popup=html.escape(self.build_ana_popup(wSource, lang, translit=translit)),
+                                   ana_popup=self.build_ana_popup(wSource, lang, translit=translit, escape=True),
                                    wf=wf,
                                    wf_display=wfDisplay,
                                    lemma=lemma,
@@ -938,7 +985,7 @@ class SentenceViewer:
                                    wID=wID,
                                    wfSearch=wSource['wf'])
         return render_template('search_results/lemma_table_row.html',
-                               ana_popup=html.escape(self.build_ana_popup(wSource, lang, translit=translit)),
+                               ana_popup=self.build_ana_popup(wSource, lang, translit=translit, escape=True),
                                wf=wf,
                                wf_display=wfDisplay,
                                lemma=lemma,
@@ -982,7 +1029,7 @@ class SentenceViewer:
 
         if searchType == 'word':
             return render_template('search_results/word_table_row.html',
-                                   ana_popup=html.escape(self.build_ana_popup(wSource, lang, translit=translit)),
+                                   ana_popup=self.build_ana_popup(wSource, lang, translit=translit, escape=True),
                                    wf=self.transliterate_baseline(wSource['wf'], lang=lang, translit=translit),
                                    lemma=self.get_lemma(wSource),
                                    gr=self.get_gramm(wSource, lang),
@@ -995,7 +1042,7 @@ class SentenceViewer:
                                    wID=w['_id'],
                                    wfSearch=wSource['wf'])
         return render_template('search_results/lemma_table_row.html',
-                               ana_popup=html.escape(self.build_ana_popup(wSource, lang, translit=translit)),
+                               ana_popup=self.build_ana_popup(wSource, lang, translit=translit, escape=True),
                                lemma=self.transliterate_baseline(wSource['wf'], lang=lang, translit=translit),
                                gr=self.get_gramm(wSource, lang),
                                word_search_display_gr=self.settings.word_search_display_gr,
@@ -1224,9 +1271,10 @@ class SentenceViewer:
             elif sortOrder == 'lemma' and searchType == 'word':
                 hitsProcessedAll['words'].sort(key=lambda w: w['_source']['lemma'])
         processedWords = []
-        for i in range(startFrom, min(len(hitsProcessedAll['words']), startFrom + pageSize)):
-            word = hitsProcessedAll['words'][i]
-            wordSource = self.sc.get_word_by_id(word['w_id'])['hits']['hits'][0]['_source']
+        pageWords = hitsProcessedAll['words'][startFrom:startFrom + pageSize]
+        wordHits = self.get_word_hits(word['w_id'] for word in pageWords)
+        for word in pageWords:
+            wordSource = wordHits[str(word['w_id'])]['_source']
             wordSource.update(word['_source'])
             word['_source'] = wordSource
             processedWords.append(self.process_word(word, lang=self.settings.languages[word['_source']['lang']],
@@ -1257,6 +1305,19 @@ class SentenceViewer:
                     w['_source']['rank'] = '&gt; ' + str(min(math.ceil(q * 100) for q in quantiles
                                                              if w['_source']['freq'] >= quantiles[q])) + '%'
 
+    def get_word_hits(self, wordIDs):
+        """
+        Retrieve several words or lemmata from the words index at once.
+        Return a dictionary {word ID as string: hit}.
+        """
+        wordIDs = set(str(wordID) for wordID in wordIDs)
+        if len(wordIDs) <= 0:
+            return {}
+        response = self.sc.get_words_by_ids(wordIDs)
+        if 'hits' not in response or 'hits' not in response['hits']:
+            return {}
+        return {str(hit['_id']): hit for hit in response['hits']['hits']}
+
     def process_doc(self, d, exclude=None):
         """
         Process one document taken from response['hits']['hits'].
@@ -1287,59 +1348,50 @@ class SentenceViewer:
         Explore the inner_hits part of the response to find the
         offsets of the words that matched the word-level query
         and offsets of the respective analyses, if any.
-        Search for word offsets recursively, so that the procedure
-        does not depend excatly on the response structure.
+        Traverse the whole structure rather than follow a fixed path,
+        so that the procedure does not depend excatly on the response structure.
         Return a dictionary where keys are offsets of highlighted words
         and values are sets of the pairs (ID of the words, ID of its ana)
         that were found by the search query .
         """
-        if 'inner_hits' in sentence:
-            return self.retrieve_highlighted_words(sentence['inner_hits'],
-                                                   numSent,
-                                                   queryWordID)
-
-        offsets = {}    # query term ID -> highlights for this query term
-        if type(sentence) == list:
-            for el in sentence:
-                if type(el) not in [dict, list]:
-                    continue
-                newOffsets = self.retrieve_highlighted_words(el, numSent, queryWordID)
-                for newK, newV in newOffsets.items():
-                    if newK not in offsets:
-                        offsets[newK] = newV
-                    else:
-                        offsets[newK] |= newV
-            return offsets
-        elif type(sentence) == dict:
-            if 'field' in sentence and sentence['field'] == 'words':
-                if 'offset' in sentence:
-                    wordOffset = 'w' + str(numSent) + '_' + str(sentence['offset'])
-                    if wordOffset not in offsets:
-                        offsets[wordOffset] = set()
-                    if queryWordID == '':
-                        queryWordID = 'w0'
+        offsets = {}
+        wnPrefix = 'w' + str(numSent) + '_'
+        stack = [(sentence, queryWordID)]   # nodes yet to be explored, in reverse order
+        while len(stack) > 0:
+            node, curQueryWordID = stack.pop()
+            if type(node) == list:
+                stack += [(el, curQueryWordID) for el in reversed(node)
+                          if type(el) in [dict, list]]
+                continue
+            elif type(node) != dict:
+                continue
+            if 'inner_hits' in node:
+                stack.append((node['inner_hits'], curQueryWordID))
+                continue
+            if 'field' in node and node['field'] == 'words':
+                if 'offset' in node:
+                    wordOffset = wnPrefix + str(node['offset'])
+                    if curQueryWordID == '':
+                        curQueryWordID = 'w0'
                     anaOffset = -1
-                    if ('_nested' in sentence
-                            and 'field' in sentence['_nested']
-                            and sentence['_nested']['field'] == 'ana'):
-                        anaOffset = sentence['_nested']['offset']
-                    offsets[wordOffset].add((queryWordID, anaOffset))
-                return offsets
-            for k, v in sentence.items():
-                curQueryWordID = queryWordID
-                mQueryWordID = re.search('^(w[0-9]+)(_[0-9]+)?$', k)
+                    if ('_nested' in node
+                            and 'field' in node['_nested']
+                            and node['_nested']['field'] == 'ana'):
+                        anaOffset = node['_nested']['offset']
+                    offsets.setdefault(wordOffset, set()).add((curQueryWordID, anaOffset))
+                continue
+            children = []
+            for k, v in node.items():
+                childQueryWordID = curQueryWordID
+                mQueryWordID = self.rxWordKey.match(k)
                 if mQueryWordID is not None:
-                    if len(queryWordID) > 0 and queryWordID != mQueryWordID.group(1):
+                    if len(curQueryWordID) > 0 and curQueryWordID != mQueryWordID.group(1):
                         continue
-                    elif len(queryWordID) <= 0:
-                        curQueryWordID = mQueryWordID.group(1)
+                    elif len(curQueryWordID) <= 0:
+                        childQueryWordID = mQueryWordID.group(1)
                 if type(v) in [dict, list]:
-                    newOffsets = self.retrieve_highlighted_words(v, numSent, curQueryWordID)
-                    for newK, newV in newOffsets.items():
-                        if newK not in offsets:
-                            offsets[newK] = newV
-                        else:
-                            offsets[newK] |= newV
+                    children.append((v, childQueryWordID))
+            stack += reversed(children)
         return offsets
 
     def get_lang_from_hit(self, hit):
@@ -1380,19 +1432,23 @@ class SentenceViewer:
             if result['n_docs'] > 0 and 'agg_nwords' in response['aggregations']:
                 result['n_occurrences'] = int(math.floor(response['aggregations']['agg_nwords']['sum']))
                 result['n_sentences'] = int(math.floor(response['aggregations']['agg_nwords']['count']))
-        for iHit in range(len(response['hits']['hits'])):
-            langID, lang = self.get_lang_from_hit(response['hits']['hits'][iHit])
+        # Metadata of all documents on the page is retrieved with one query
+        docCache = self.get_docs_meta(set(hit['_source']['doc_id']
+                                          for hit in response['hits']['hits']
+                                          if '_source' in hit and 'doc_id' in hit['_source']))
+        for iHit, hit in enumerate(response['hits']['hits']):
+            langID, lang = self.get_lang_from_hit(hit)
             langView = lang
-            if ('_source' in response['hits']['hits'][iHit]
-                    and 'transVar' in response['hits']['hits'][iHit]['_source']):
-                langView += '_' + str(response['hits']['hits'][iHit]['_source']['transVar'])
+            if '_source' in hit and 'transVar' in hit['_source']:
+                langView += '_' + str(hit['_source']['transVar'])
             resultLanguages.add(langView)
-            curContext = self.process_sentence(response['hits']['hits'][iHit],
+            curContext = self.process_sentence(hit,
                                                numSent=iHit,
                                                getHeader=True,
                                                lang=lang,
                                                langView=langView,
-                                               translit=translit)
+                                               translit=translit,
+                                               docCache=docCache)
             if 'src_alignment' in curContext:
                 srcAlignmentInfo.update(curContext['src_alignment'])
             result['contexts'].append(curContext)
@@ -1452,27 +1508,33 @@ class SentenceViewer:
         result['n_docs'] = response['aggregations']['agg_ndocs']['value']
         result['total_freq'] = response['aggregations']['agg_freq']['value']
         result['words'] = []
+        buckets = response['aggregations']['agg_group_by_word']['buckets']
         # print(response['aggregations']['agg_group_by_word']['buckets'])
-        for iHit in range(len(response['aggregations']['agg_group_by_word']['buckets'])):
+        if subcorpus:
+            wordIDs = [bucket['key'] for bucket in buckets]
+        else:
+            wordIDs = [bucket['key']['l_id'] for bucket in buckets]
+        # All words of the page are retrieved with one query
+        wordHits = self.get_word_hits(wordIDs)
+        for iHit in range(len(buckets)):
+            wordID = wordIDs[iHit]
             if subcorpus:
-                wordID = response['aggregations']['agg_group_by_word']['buckets'][iHit]['key']
-                nForms = response['aggregations']['agg_group_by_word']['buckets'][iHit]['subagg_nforms']['value']
-                docCount = response['aggregations']['agg_group_by_word']['buckets'][iHit]['doc_count']
+                nForms = buckets[iHit]['subagg_nforms']['value']
+                docCount = buckets[iHit]['doc_count']
             else:
-                wordID = response['aggregations']['agg_group_by_word']['buckets'][iHit]['key']['l_id']
-                nForms = response['aggregations']['agg_group_by_word']['buckets'][iHit]['doc_count']
+                nForms = buckets[iHit]['doc_count']
                 docCount = -1
             try:
                 # If this was a subcorpus search, then total frequency of
                 # found items comes from word[wtype=word_freq] objects and
                 # therefore is stored in a subaggregation.
                 # If not, it will be taken from the item itself by process_word_buckets.
-                wordFreq = response['aggregations']['agg_group_by_word']['buckets'][iHit]['subagg_freq']['value']
+                wordFreq = buckets[iHit]['subagg_freq']['value']
             except KeyError:
                 wordFreq = None
-            hit = self.sc.get_word_by_id(wordID)
-            langID, lang = self.get_lang_from_hit(hit['hits']['hits'][0])
-            result['words'].append(self.process_word_buckets(hit['hits']['hits'][0],
+            hit = wordHits[str(wordID)]
+            langID, lang = self.get_lang_from_hit(hit)
+            result['words'].append(self.process_word_buckets(hit,
                                                              nDocuments=docCount,
                                                              nForms=nForms,
                                                              freq=wordFreq,